@@ -1,32 +1,47 @@
-from xml.etree.ElementTree import tostring
+### Heavy dependencies (requests, bs4, qrcode, PIL) are imported inside the methods that use them,
+### so importing this module (and starting the GUI) stays fast on a cold start.
 import Methods
-import requests
 import json
-from bs4 import BeautifulSoup
 from urllib.parse import urlparse
 from urllib.parse import urljoin
-import qrcode
-from PIL import Image
 import io
 import os
 import re
 import zipfile
 import csv
 from pathlib import Path
+import itertools
+import math
+import contextlib
+import threading
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 
 DEFAULT_IMG_SAVE_LOC = "images/"
 DEFAULT_CSV_SAVE_LOC = "CSV_FILES/"
 ### Adobe docs specify that DataMerge should work with paths relative to the CSV, but it does not, so leave this field empty.
 DEFAULT_IMG_SAVE_ZIP = "" 
 DEFAULT_CSV_SAVE_ZIP = "CSV_FILES/"
+### Below this many posts, extract_posts stays serial even if asked for processes, since starting a pool costs more than it saves
+PARALLEL_EXTRACT_MIN_POSTS = 64
+### How long PostPrefetcher.cancel waits for posts that are mid-download, before leaving them to finish on their own
+PREFETCH_CANCEL_WAIT = 1
+### Post attributes that get_state/from_state carry over (images are saved separately, see Snapshot.py)
+POST_STATE_FIELDS = ['id', 'title', 'exerpt', 'date', 'link', 'author', 'featured_image', 'images', 'body', 'custom_feature']
+
+### Guards creating a post's downloaded_images, which the prefetcher and the GUI thread can both try at once
+_downloaded_images_lock = threading.Lock()
+### True inside extract_posts' pool workers, which skip the posts.json dump so they don't all overwrite the same file
+_in_extract_worker = False
 
 
 class Post:
-    def __init__(self, post):
-        """Initialize Post and fill variables from JSON"""
+    def __init__(self, post, deadline=None):
+        """Initialize Post and fill variables from JSON. Looking up the featured image stops once deadline passes."""
 
-        with open("posts.json", "w", encoding="utf-8") as f:
-            json.dump(post, f, ensure_ascii=False, indent=2)
+        if not _in_extract_worker:
+            with open("posts.json", "w", encoding="utf-8") as f:
+                json.dump(post, f, ensure_ascii=False, indent=2)
 
         self.id = post.get('id')
         self.title = post.get('title', {}).get('rendered', '')
@@ -38,7 +53,7 @@ class Post:
         # Clean up the title, should not be any HTML but just to be sure:
         self.title =Methods.clean_text(self.title)
 
-        featured_media = Methods.get_featured_media(post)
+        featured_media = Methods.get_featured_media(post, deadline)
         if featured_media:
             self.featured_image = {
                 'url': featured_media.get('source_url'),
@@ -47,6 +62,7 @@ class Post:
                 }
 
         # Extract images from content using BeautifulSoup
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(post['content']['rendered'], 'html.parser')
         img_tags = soup.find_all('img')
         self.images = [
@@ -65,8 +81,21 @@ class Post:
 
         self.body = Methods.clean_text(self.body)
 
+    def get_state(self):
+        """Returns the post's text, metadata, edits and chosen image as plain data, for saving snapshots"""
+        return {k: v for k, v in vars(self).items() if k in POST_STATE_FIELDS}
+
+    @classmethod
+    def from_state(cls, state):
+        """Rebuild a Post from get_state() output, without parsing any JSON or touching the network. Only POST_STATE_FIELDS are taken."""
+        post = cls.__new__(cls)
+        post.__dict__.update({field: state[field] for field in POST_STATE_FIELDS if field in state})
+        return post
+
     def generate_qr_code(self, size=10, border=4):
         """Generate QR code from the post URL"""
+        import qrcode
+
         qr = qrcode.QRCode(
             version=1,  # Controls size (1 is smallest)
             error_correction=qrcode.constants.ERROR_CORRECT_L,  # Low error correction
@@ -82,24 +111,55 @@ class Post:
 
         return self.qr_code
     
-    def download_images(self, allimages = False):
-        "Downloads all images in a post, puts images into downloaded_images"
-        self.downloaded_images = { }
+    def download_images(self, allimages = False, deadline = None):
+        """
+        Downloads all images in a post, puts images into downloaded_images. Images that are already downloaded are skipped.
+        Images that fail, or aren't reached before deadline, are left out (and tried again next call).
+        """
+        # Held as encoded bytes in the shared, memory-bounded image store, and decoded when used
+        with _downloaded_images_lock:
+            if not hasattr(self, "downloaded_images"):
+                self.downloaded_images = Methods.PostImages()
+            # Keys of images that were tried but failed or ran out of time, see get_zip_image
+            if not hasattr(self, "failed_downloads"):
+                self.failed_downloads = set()
 
         #Get featured image
-        if hasattr(self, "featured_image"):
+        if hasattr(self, "featured_image") and self.featured_key() not in self.downloaded_images:
             print("Found featured image!")
-            self.downloaded_images[self.featured_key()] = Methods.download_image(self.featured_image['url'])
+            data = Methods.download_image_bytes(self.featured_image['url'], deadline)
+            self.note_download(self.featured_key(), data)
             
         #Download other images in article, if it's asked or if a custom_feature is set.
         if allimages or (hasattr(self, "custom_feature") and self.custom_feature):
             print("Downloading other images...")
             for index, image in enumerate(self.images):
-                self.downloaded_images[self.img_key(index)] = Methods.download_image(image['url'])
-                print("Image downloaded!")
+                if self.img_key(index) in self.downloaded_images:
+                    continue
+                data = Methods.download_image_bytes(image['url'], deadline)
+                if self.note_download(self.img_key(index), data):
+                    print("Image downloaded!")
 
         return self.downloaded_images
 
+    def note_download(self, key, data):
+        """Store a download's bytes under key, or note it as failed if data is None. Returns True if it succeeded."""
+        if data is None:
+            self.failed_downloads.add(key)
+            return False
+        self.downloaded_images.put_bytes(key, data)
+        self.failed_downloads.discard(key)
+        return True
+
+    def prefetch(self, deadline=None):
+        """Downloads the featured image and generates the QR code. Meant to be run by a PostPrefetcher worker."""
+        self.download_images(deadline=deadline)
+
+        if not hasattr(self, "qr_code"):
+            self.generate_qr_code()
+
+        return self
+
     def featured_key(self):
         """Returns standard key for featured image"""
         return 'featured'
@@ -125,45 +185,61 @@ class Post:
         """Returns standard filename for qr code"""
         return str(self.id) + "_qr_code.png"
 
-    def zip_images(self, zip_buffer : Methods.ZipBuilder, allimages = False):
-        """Add all post images into a Zip file, generate/downloads images where necessary"""
-        if not hasattr(self, "downloaded_images"):
-            self.download_images()
+    def zip_images(self, zip_buffer : Methods.ZipBuilder, allimages = False, deadline = None):
+        """
+        Add all post images into a Zip file, generate/downloads images where necessary.
+        Images that can't be downloaded (before deadline) are replaced by a placeholder, their keys are listed in placeholders.
+        """
+        self.download_images(allimages, deadline)
 
         zip_paths = { }
+        self.placeholders = [ ]
+        has_custom_feature = hasattr(self, 'custom_feature') and self.custom_feature
 
-        if hasattr(self, "featured_image") and self.featured_image:
-            zip_buffer.add_image(self.downloaded_images[self.featured_key()], DEFAULT_IMG_SAVE_ZIP, self.get_featured_filename())
-            zip_paths[self.featured_key()] = DEFAULT_IMG_SAVE_ZIP + self.get_featured_filename()
+        # Images identical to one already in the zip (e.g. a shared featured graphic) point at the stored copy
+        if (hasattr(self, "featured_image") and self.featured_image) or not has_custom_feature:
+            zip_paths[self.featured_key()] = zip_buffer.add_unique_image(self.get_zip_image(self.featured_key()), DEFAULT_IMG_SAVE_ZIP, self.get_featured_filename())
         
         if not hasattr(self,"qr_code"):
             self.generate_qr_code()
         
-        zip_buffer.add_image(self.qr_code, DEFAULT_IMG_SAVE_ZIP, self.get_qr_filename())
-        zip_paths[self.qr_key()] = DEFAULT_IMG_SAVE_ZIP + self.get_qr_filename()
-
-        article_images = {k: v for k, v in self.downloaded_images.items() if k != self.featured_key()}
-        if hasattr(self, 'custom_feature') and self.custom_feature:
-            for index, image in enumerate(article_images):
-                zip_buffer.add_image(self.downloaded_images[self.img_key(index)], DEFAULT_IMG_SAVE_ZIP, self.get_img_filename(index))
-                zip_paths[self.img_key(index)] = DEFAULT_IMG_SAVE_ZIP + self.get_img_filename(index)
+        zip_paths[self.qr_key()] = zip_buffer.add_unique_image(self.qr_code, DEFAULT_IMG_SAVE_ZIP, self.get_qr_filename())
+
+        if has_custom_feature:
+            for index, image in enumerate(self.images):
+                zip_paths[self.img_key(index)] = zip_buffer.add_unique_image(self.get_zip_image(self.img_key(index)), DEFAULT_IMG_SAVE_ZIP, self.get_img_filename(index))
         
         self.image_paths = zip_paths
         return zip_buffer
 
+    def get_zip_image(self, key):
+        """
+        Returns a downloaded image's encoded bytes, or the placeholder's if it's missing.
+        Only the image the CSV uses, and only if its download failed or ran out of time, is noted in placeholders.
+        """
+        if key not in self.downloaded_images:
+            if key == self.CSV_image_key() and key in self.failed_downloads:
+                self.placeholders.append(key)
+            return Methods.placeholder_image()
+        return self.downloaded_images.get_bytes(key)
+
+    def CSV_image_key(self):
+        """Returns the key of the image that goes in the post's CSV entry: the custom feature if one is set, else the featured image"""
+        if hasattr(self, "custom_feature") and self.custom_feature:
+            return self.img_key(self.custom_feature)
+        return self.featured_key()
+
     def get_CSV_helper(self, image_paths, index = 0):
         """Returns one CSV entry containing headline, article body, and absolute filepaths to the QR code & featured image. Will save images/QR code"""
+        suffix = Methods.slot_suffix(index)
         CSV = {
-                "Title_" + chr(index + 65) : self.title,
-                "Body_" + chr(index + 65) : self.body,
-                "@QR_" + chr(index + 65) : image_paths[self.qr_key()],
-                "Author_" + chr(index + 65) : self.author
+                "Title_" + suffix : self.title,
+                "Body_" + suffix : self.body,
+                "@QR_" + suffix : image_paths[self.qr_key()],
+                "Author_" + suffix : self.author
                 }
             
-        if hasattr(self, "custom_feature") and self.custom_feature:
-            CSV["@image_" + chr(index + 65)] = image_paths[self.img_key(self.custom_feature)]
-        else:
-            CSV["@image_" + chr(index + 65)] = image_paths[self.featured_key()]
+        CSV["@image_" + suffix] = image_paths[self.CSV_image_key()]
         
         return CSV
 
@@ -173,6 +249,128 @@ class Post:
         return self.get_CSV_helper(self.image_paths, index)
             
             
+def get_flyer_CSV(posts, posts_per_flyer=None):
+    """
+    Returns DataMerge CSV rows (header first) for posts that have already been through zip_images.
+    
+    By default every post goes into one row, since a flyer is one DataMerge record. With posts_per_flyer set,
+    posts are split into flyers of that many slots each, one row per flyer, all sharing the same headers, so
+    one archive can feed a multi-record merge. Empty slots on the last flyer are left blank.
+    posts can be any iterable: only each post's CSV entry is kept, not the post itself.
+    """
+    header = [ ]
+    entries = [ ]
+    for index, post in enumerate(posts):
+        slot = index % posts_per_flyer if posts_per_flyer else index
+        if slot == 0:
+            entries.append({ })
+        entries[-1].update(post.get_CSV_entry_zip(slot))
+
+    for entry in entries:
+        for key in entry:
+            if key not in header:
+                header.append(key)
+
+    return [header] + [[entry.get(key, '') for key in header] for entry in entries]
+
+
+
+def build_flyer_zip(posts, zip_buffer=None, posts_per_flyer=None, deadline=None):
+    """
+    Download, zip and add CSV entries for posts from any iterable, one post at a time as they arrive,
+    e.g. straight from WordPressExtractor.iter_posts. Returns the ZipBuilder, with flyer_autofill.csv added.
+    Each post can be let go once it has been zipped, only its CSV entry is kept.
+    """
+    if zip_buffer is None:
+        zip_buffer = Methods.ZipBuilder()
+
+    def zipped_posts():
+        for post in posts:
+            post.zip_images(zip_buffer, deadline=deadline)
+            yield post
+
+    zip_buffer.add_csv(get_flyer_CSV(zipped_posts(), posts_per_flyer), "flyer_autofill.csv")
+    return zip_buffer
+
+
+class PostPrefetcher:
+    """
+    Downloads featured images and generates QR codes for posts in background threads,
+    so the work is already done by the time the user asks for it.
+    """
+
+    def __init__(self, max_workers=8):
+        """Initialize an idle prefetcher with its own thread pool."""
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self.jobs = { }
+        self.deadlines = { }
+
+    def submit(self, posts, deadline=None):
+        """Queue posts for prefetching, posts that are already queued are skipped. Returns self for chaining."""
+        for post in posts:
+            if post.id not in self.jobs:
+                self.deadlines[post.id] = deadline if deadline is not None else Methods.Deadline()
+                self.jobs[post.id] = self.executor.submit(post.prefetch, self.deadlines[post.id])
+        return self
+
+    def is_done(self, post):
+        """True if prefetching for post has finished (or the post was never queued)"""
+        job = self.jobs.get(post.id)
+        return job is None or job.done()
+
+    def done_count(self):
+        """Returns the number of posts whose prefetching has finished"""
+        return sum(1 for job in self.jobs.values() if job.done())
+
+    def wait(self, post=None, timeout=None):
+        """
+        Block until prefetching for post has finished, or timeout seconds have passed. If post is None, waits for every queued post.
+        Returns True if everything waited on has finished.
+        """
+        jobs = self.jobs.values() if post is None else [self.jobs[post.id]] if post.id in self.jobs else []
+
+        done, pending = futures.wait(jobs, timeout)
+        for job in done:
+            # The explicit buttons will retry whatever failed, so don't let one bad image stop the others.
+            if not job.cancelled() and job.exception() is not None:
+                print(f"Error prefetching post: {job.exception()}")
+
+        return not pending
+
+    def cancel(self, timeout=PREFETCH_CANCEL_WAIT):
+        """
+        Give up on unfinished posts: queued ones never start, running ones stop before their next request.
+        Then waits up to timeout seconds for the running ones, so they are usually out of the way before the caller
+        touches the same posts (anything still mid-download after that only adds images, under PostImages' lock).
+        """
+        running = [ ]
+        for post_id, job in self.jobs.items():
+            if not job.done():
+                if not job.cancel():
+                    running.append(job)
+                self.deadlines[post_id].cancel()
+
+        if running:
+            futures.wait(running, timeout)
+
+    def shutdown(self):
+        """Stop the worker threads, dropping anything that has not started yet"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def __len__(self):
+        """Return the number of queued posts."""
+        return len(self.jobs)
+
+
+def extract_pool(processes):
+    """Returns a process pool for parsing Posts, see WordPressExtractor.extract_posts"""
+    # Imported here, only archive imports need it
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(max_workers=processes, initializer=_start_extract_worker)
+
+def _start_extract_worker():
+    global _in_extract_worker
+    _in_extract_worker = True
 
 
 class WordPressExtractor:
@@ -181,8 +379,13 @@ class WordPressExtractor:
         self.base_url = base_url.rstrip('/')
         self.api_url = urljoin(self.base_url, '/wp-json/wp/v2/')
 
-    def get_posts(self, per_page=10, page=1):
+    def get_posts(self, per_page=10, page=1, deadline=None):
         """Fetch posts from WordPress REST API"""
+        import requests
+
+        if deadline is None:
+            deadline = Methods.Deadline()
+
         url = urljoin(self.api_url, 'posts?_embed=1')
         print(url)
         params = {
@@ -192,7 +395,9 @@ class WordPressExtractor:
         }
         
         try:
-            response = requests.get(url, params=params)
+            # Goes through the host's adaptive throttle. If the host keeps answering 429/503, ThrottledError
+            # is raised rather than returning [], so it isn't mistaken for "no posts"
+            response = Methods.http_get(url, deadline, timeout=30, params=params)
             response.encoding = 'utf-8'
             response.raise_for_status()
             return response.json()
@@ -204,39 +409,106 @@ class WordPressExtractor:
             
             pass
 
-    def extract_posts(self, posts):
-        """Extract title, content, and images from posts"""
-        extracted_posts = []
+    def extract_posts(self, posts, deadline=None, processes=1, pool=None):
+        """
+        Extract title, content, and images from posts.
         
-        for post in posts:
-            extracted_posts.append(Post(post))
+        Parsing the HTML is CPU-bound, so for archive imports set processes (None for one per core) to spread the posts
+        over a process pool in chunks. Results keep the order of posts. Inputs smaller than PARALLEL_EXTRACT_MIN_POSTS stay serial.
+        Pass a pool from extract_pool to reuse it across calls, otherwise one is started and shut down for this call.
+        """
+        posts = list(posts)
+        if processes is None:
+            processes = os.cpu_count() or 1
+
+        if processes > 1 and len(posts) >= PARALLEL_EXTRACT_MIN_POSTS:
+            # A few chunks per worker keeps them all busy without paying to pickle every post separately
+            chunksize = math.ceil(len(posts) / (processes * 4))
+            with (extract_pool(processes) if pool is None else contextlib.nullcontext(pool)) as pool:
+                extracted_posts = list(pool.map(Post, posts, itertools.repeat(deadline), chunksize=chunksize))
+        else:
+            extracted_posts = []
+            
+            for post in posts:
+                extracted_posts.append(Post(post, deadline))
 
         self.posts = extracted_posts
         return extracted_posts
+
+    def index_posts(self, posts, index):
+        """Add raw posts to a PostIndex with cleaned text, without building Post objects or fetching any media"""
+        rows = [ ]
+
+        for post in posts:
+            rows.append({
+                'id': post.get('id'),
+                'title': Methods.clean_text(post.get('title', {}).get('rendered', '')),
+                'body': Methods.clean_text(post.get('content', {}).get('rendered', '')),
+                'author': post.get('author_meta', {}).get('display_name', ''),
+                'date': post.get('date'),
+                'link': post.get('guid', {}).get('rendered', post.get('link', '')),
+                'raw': post
+                })
+
+        return index.add(rows)
+
+    def index_all_posts(self, index, max_posts=None):
+        """Fetch posts with pagination, adding each page to a PostIndex as it arrives"""
+        count = 0
+
+        for posts in self.iter_pages(max_posts):
+            count += self.index_posts(posts, index)
+
+        return count
     
     def get_all_posts(self, max_posts=None):
         """Fetch all posts with pagination"""
         all_posts = []
+        
+        for posts in self.iter_pages(max_posts):
+            all_posts.extend(posts)
+        
+        return all_posts
+
+    def iter_pages(self, max_posts=None, per_page=100, deadline=None):
+        """
+        Generator over the raw posts, one page (list of post dicts) at a time. Each page is only requested
+        once the previous one has been consumed, so only one page of raw JSON needs to be held at once.
+        """
         page = 1
-        per_page = 100
+        count = 0
         
         while True:
-            posts = self.get_posts(per_page=per_page, page=page)
+            posts = self.get_posts(per_page=per_page, page=page, deadline=deadline)
             if not posts:
                 break
             
-            all_posts.extend(posts)
-            
-            if max_posts and len(all_posts) >= max_posts:
-                all_posts = all_posts[:max_posts]
+            if max_posts and count + len(posts) >= max_posts:
+                yield posts[:max_posts - count]
                 break
             
-            if len(posts) < per_page:  # Last page
+            count += len(posts)
+            last_page = len(posts) < per_page
+            yield posts
+            
+            if last_page:
                 break
             
             page += 1
-        
-        return all_posts
+
+    def iter_posts(self, max_posts=None, per_page=100, deadline=None, processes=1):
+        """
+        Generator over Post objects, parsed page by page as each response arrives (see extract_posts for processes).
+        Only the current page of raw dicts is held, iter_pages lets it go when the next page is requested.
+        Feed it to index, download or zip stages (e.g. build_flyer_zip) to process posts as they arrive.
+        """
+        if processes is None:
+            processes = os.cpu_count() or 1
+
+        # One pool for the whole archive, rather than starting worker processes for every page
+        with (extract_pool(processes) if processes > 1 else contextlib.nullcontext()) as pool:
+            for posts in self.iter_pages(max_posts, per_page, deadline):
+                yield from self.extract_posts(posts, deadline, processes, pool)
     
     def generate_qr_code(self, filename=None):
         """Generate QR code for the main WordPress site"""
@@ -257,6 +529,8 @@ class WordPressExtractor:
 
 # Example usage and demonstration
 if __name__ == "__main__":
+    from PIL import Image
+
     # Create some sample images
     red_img = Image.new('RGB', (100, 100), 'red')
     blue_img = Image.new('RGB', (150, 150), 'blue')
@@ -1,12 +1,12 @@
 ﻿import streamlit as st
-import pandas as pd
-from PIL import Image
 import io
 import base64
-from Flyer_Generator import WordPressExtractor, Post
-import tempfile
-import os
+from Flyer_Generator import WordPressExtractor, Post, PostPrefetcher, build_flyer_zip
+from Post_Index import PostIndex
+import Snapshot
 import re
+import os
+import math
 import Methods
 
 # Set page config
@@ -42,10 +42,13 @@ def display_image_selector(post, post_index):
         st.write("No images available for this post")
         return None, None
     
-    # Image selection dropdown
+    # Image selection dropdown, starting from the post's chosen image (e.g. one restored from a snapshot)
+    options = list(available_images.keys())
+    chosen = f'Article Image {post.custom_feature + 1}' if hasattr(post, 'custom_feature') and post.custom_feature else None
     selected_image_key = st.selectbox(
         "Select Image:",
-        list(available_images.keys()),
+        options,
+        index=options.index(chosen) if chosen in options else 0,
         key=f"img_select_{int(post_index)}"
     )
     
@@ -60,13 +63,14 @@ def display_image_selector(post, post_index):
     
     # Display selected image if it exists in downloaded images
     if hasattr(post, 'downloaded_images'):
+        # Streamlit can show the encoded bytes directly, so there's no need to decode the image
         if selected_image_key == 'Featured Image' and 'featured' in post.downloaded_images:
-            display_img = post.downloaded_images['featured']
+            display_img = post.downloaded_images.get_bytes('featured')
         else:
             # Find corresponding downloaded image
             for i, img in enumerate(post.images):
                 if img == selected_image and f'img_{i}' in post.downloaded_images:
-                    display_img = post.downloaded_images[f'img_{i}']
+                    display_img = post.downloaded_images.get_bytes(f'img_{i}')
                     break
             else:
                 display_img = None
@@ -118,17 +122,20 @@ def display_post_card(post, index, total_posts, is_expanded=False):
                 else:
                     if st.button(f"Generate QR Code", key=f"qr_{int(index)}"):
                         with st.spinner("Generating QR code..."):
-                            post.generate_qr_code()
+                            wait_for_prefetch(post)
+                            if not hasattr(post, 'qr_code'):
+                                post.generate_qr_code()
                             st.rerun()
             
             with col2:
                 st.subheader("Article Details")
                 
                 # Title (editable)
+                # Keyed by post ID rather than position, so edits stay with their post when posts are reordered
                 title = st.text_input(
                     "Title:",
                     value=post.title,
-                    key=f"title_{int(index)}"
+                    key=f"title_{post.id}"
                 )
                 
                 # Article body (editable)
@@ -136,9 +143,13 @@ def display_post_card(post, index, total_posts, is_expanded=False):
                     "Body:",
                     value=post.body,
                     height=200,
-                    key=f"body_{int(index)}"
+                    key=f"body_{post.id}"
                 )
                 
+                # Keep edits on the post, so they make it into the CSV and session snapshots
+                post.title = title
+                post.body = body
+                
                 # Post metadata
                 st.write(f"**Post ID:** {post.id}")
                 st.write(f"**Date:** {post.date}")
@@ -147,13 +158,14 @@ def display_post_card(post, index, total_posts, is_expanded=False):
             # Action buttons
             if st.button(f"Fetch Article Images", key=f"download_{int(index)}"):
                 with st.spinner("Downloading images..."):
+                    wait_for_prefetch(post)
                     post.download_images(True)
                     st.success("Images downloaded!")
                     st.rerun()
 
 def main():
     headcol1, headcol2 = st.columns([1,10], vertical_alignment = "center")
-    headcol1.image("logo.png")
+    headcol1.image(os.path.join(os.path.dirname(os.path.abspath(__file__)), "logo.png"))
     headcol2.title("The Front Page Stand-Flyer Generator")
     headcol2.text("Created by Seth Ciancio")
     st.divider()
@@ -180,9 +192,64 @@ def main():
             help="How many recent posts to fetch from WordPress"
         )
         
+        # Time budget for each job
+        time_budget = st.number_input(
+            "Time Budget (seconds):",
+            min_value=0,
+            value=0,
+            help="0 means no limit. How long Fetch Posts (including its image downloads) and Generate Zip File may take; images that haven't arrived in time are replaced by a placeholder"
+        )
+        
         # Fetch posts button
         if st.button("Fetch Posts", type="primary"):
-            fetch_posts(wp_url, num_posts)
+            fetch_posts(wp_url, num_posts, time_budget)
+        
+        # Batch export
+        posts_per_flyer = st.number_input(
+            "Posts per Flyer:",
+            min_value=0,
+            value=0,
+            help="0 puts every post on one flyer. Otherwise posts are split into flyers with this many slots, one CSV row per flyer, for a multi-record DataMerge"
+        )
+        
+        st.header("Archive Search")
+        
+        # Number of posts to index
+        num_indexed = st.number_input(
+            "Number of Posts to Index:",
+            min_value=1,
+            max_value=10000,
+            value=500,
+            help="How many posts to pull from the archive into the local search index"
+        )
+        
+        if st.button("Index Archive"):
+            index_archive(wp_url, num_indexed)
+        
+        st.header("Session")
+        
+        if st.button("Save Session", disabled=not st.session_state.get('posts')):
+            save_session()
+        
+        if 'snapshot' in st.session_state:
+            st.download_button(
+                label="Download Session Snapshot",
+                data=st.session_state.snapshot,
+                file_name="flyer_session.flyer",
+                mime="application/octet-stream"
+            )
+        
+        snapshot_file = st.file_uploader("Load Session:", type=["flyer"], help="Restore posts, edits and images from a saved snapshot")
+        if snapshot_file is not None and snapshot_file.file_id != st.session_state.get('loaded_snapshot'):
+            load_session(snapshot_file)
+        
+        st.header("Memory")
+        show_memory_use()
+    
+    search_archive()
+    
+    # Rate limiting hit by the last Fetch Posts (background prefetching is reported with the zip)
+    show_throttling(st.session_state.get('fetch_throttling', { }))
     
     # Main content area
     if 'posts' not in st.session_state:
@@ -195,6 +262,7 @@ def main():
     
     # Post management section
     st.header(f"Manage Posts ({len(st.session_state.posts)} posts loaded)")
+    prefetch_status()
     
     # Bulk actions
     col1, col3 = st.columns(2)
@@ -205,7 +273,7 @@ def main():
     
     with col3:
         if st.button("Generate Zip File"):
-            generate_all_zip()
+            generate_all_zip(posts_per_flyer, time_budget)
     
     st.markdown("---")
     
@@ -214,24 +282,171 @@ def main():
         display_post_card(post, i, len(st.session_state.posts), is_expanded=(i == 0))  # First post expanded by default
         st.markdown("---")
 
-def fetch_posts(wp_url, num_posts):
-    """Fetch posts from WordPress site"""
+def fetch_posts(wp_url, num_posts, time_budget=0):
+    """Fetch posts from WordPress site. The time budget covers fetching and the background image downloads."""
     try:
         with st.spinner(f"Fetching {num_posts} posts from {wp_url}..."):
+            deadline = Methods.Deadline(time_budget or None)
             extractor = WordPressExtractor(wp_url)
-            raw_posts = extractor.get_posts(per_page=num_posts)
+            raw_posts = extractor.get_posts(per_page=num_posts, deadline=deadline)
+            # Shown on the main page, which is redrawn after the rerun below
+            st.session_state.fetch_throttling = deadline.throttle_stats()
             
             if raw_posts:
-                posts = extractor.extract_posts(raw_posts)
+                posts = extractor.extract_posts(raw_posts, deadline)
                 st.session_state.posts = posts
+                start_prefetch(posts, deadline)
                 st.success(f"Successfully fetched {len(posts)} posts!")
                 st.rerun()
             else:
                 st.error("No posts found or API not accessible")
     
+    except Methods.ThrottledError as e:
+        st.error(f"The site is rate limiting us, try again in a little while: {str(e)}")
+    
     except Exception as e:
         st.error(f"Error fetching posts: {str(e)}")
 
+def show_throttling(*job_stats):
+    """List the hosts that rate limited (429/503) this job, from the Deadline.throttle_stats() of its parts"""
+    for host in Methods.throttle_report(*job_stats):
+        st.info(f"{host['host']} rate limited {host['throttled']} request{'s' if host['throttled'] > 1 else ''} from this job: "
+                f"waited {host['waited']:.1f}s. It is allowing {host['limit']} at a time for now, shared by everyone using this server")
+
+def index_archive(wp_url, num_posts):
+    """Fetch posts from the WordPress archive into the local search index"""
+    try:
+        with st.spinner(f"Indexing {num_posts} posts from {wp_url}..."):
+            # Post IDs are only unique within a site, so start over when the site changes
+            if st.session_state.get('post_index_site') != wp_url:
+                st.session_state.post_index = PostIndex()
+                st.session_state.post_index_site = wp_url
+
+            # Pages are indexed as they arrive, rather than holding the whole archive's JSON first
+            extractor = WordPressExtractor(wp_url)
+            status_text = st.empty()
+            count = 0
+            for raw_posts in extractor.iter_pages(num_posts):
+                count += extractor.index_posts(raw_posts, st.session_state.post_index)
+                status_text.text(f"Indexed {count} posts...")
+
+            st.success(f"Indexed {count} posts!")
+    
+    except Exception as e:
+        st.error(f"Error indexing posts: {str(e)}")
+
+def search_archive():
+    """Search box over the local archive index. Posts are only built (and their images fetched) once picked."""
+    if 'post_index' not in st.session_state:
+        return
+
+    index = st.session_state.post_index
+    st.header(f"Search Archive ({len(index)} posts indexed)")
+
+    query = st.text_input("Search:", key="archive_query", placeholder="Words from the title, body or author")
+    if not query:
+        return
+
+    results = index.search(query)
+    if not results:
+        st.write("No matching posts")
+        return
+
+    loaded = {post.id for post in st.session_state.get('posts', [])}
+    picked = [ ]
+    for result in results:
+        label = f"**{result['title']}** ({(result['date'] or '')[:10]}, {result['author']})"
+        if st.checkbox(label, key=f"pick_{result['id']}", disabled=result['id'] in loaded):
+            picked.append(result['id'])
+        st.caption(result['snippet'])
+
+    if st.button("Add Selected Posts", disabled=not picked):
+        add_indexed_posts(picked)
+
+def add_indexed_posts(post_ids):
+    """Build Posts for the picked search results and add them to the flyer"""
+    raw_posts = st.session_state.post_index.get_raw_posts(post_ids)
+    posts = WordPressExtractor(st.session_state.post_index_site).extract_posts(raw_posts)
+
+    if 'posts' not in st.session_state:
+        st.session_state.posts = [ ]
+    st.session_state.posts.extend(posts)
+
+    if 'prefetcher' in st.session_state:
+        st.session_state.prefetcher.submit(posts)
+    else:
+        start_prefetch(posts)
+
+    st.rerun()
+
+def save_session():
+    """Snapshot the current posts, their edits and their images, ready to download"""
+    with st.spinner("Saving session..."):
+        wait_for_prefetch()
+        if 'image_cache' not in st.session_state:
+            st.session_state.image_cache = Methods.ImageCache()
+        st.session_state.snapshot = Snapshot.dumps(st.session_state.posts, st.session_state.image_cache)
+
+def load_session(snapshot_file):
+    """Replace the current posts with the ones in an uploaded snapshot"""
+    st.session_state.loaded_snapshot = snapshot_file.file_id
+    try:
+        posts = Snapshot.loads(snapshot_file.getvalue())
+    except ValueError as e:
+        st.error(f"Error loading session: {str(e)}")
+        return
+
+    # Drop widget state left over from earlier posts with the same IDs (or, for image selectors, the same position),
+    # so the loaded edits and image choices show
+    for post in posts:
+        st.session_state.pop(f"title_{post.id}", None)
+        st.session_state.pop(f"body_{post.id}", None)
+    for key in [key for key in st.session_state if str(key).startswith("img_select_")]:
+        st.session_state.pop(key)
+
+    st.session_state.posts = posts
+    st.session_state.pop('snapshot', None)
+    st.session_state.pop('fetch_throttling', None)
+    start_prefetch(posts)
+    st.rerun()
+
+def start_prefetch(posts, deadline=None):
+    """Start downloading featured images and generating QR codes in the background, replacing any older prefetcher"""
+    if 'prefetcher' in st.session_state:
+        st.session_state.prefetcher.shutdown()
+
+    # One deadline for the whole prefetch, so its throttling can be reported with the next zip
+    st.session_state.prefetch_deadline = deadline if deadline is not None else Methods.Deadline()
+    st.session_state.throttling_checkpoint = st.session_state.prefetch_deadline.throttle_stats()
+    st.session_state.prefetcher = PostPrefetcher().submit(posts, st.session_state.prefetch_deadline)
+    st.session_state.prefetch_seen = 0
+
+def wait_for_prefetch(post=None, timeout=None):
+    """
+    Block until background prefetching for post has finished (or for every post, if post is None), or timeout seconds pass.
+    Returns True if it finished.
+    """
+    if 'prefetcher' in st.session_state:
+        return st.session_state.prefetcher.wait(post, timeout)
+    return True
+
+@st.fragment(run_every=1)
+def prefetch_status():
+    """Show prefetch progress, and rerun the app whenever more posts finish so the cards pick up the results"""
+    if 'prefetcher' not in st.session_state:
+        return
+
+    prefetcher = st.session_state.prefetcher
+    done = prefetcher.done_count()
+
+    if done < len(prefetcher):
+        st.progress(done / len(prefetcher), text=f"Prefetching images & QR codes: {done}/{len(prefetcher)}")
+
+    seen = st.session_state.get('prefetch_seen', done)
+    st.session_state.prefetch_seen = done
+    if done != seen:
+        st.rerun()
+
 def download_all_images():
     """Download images for all posts"""
     if 'posts' not in st.session_state:
@@ -239,50 +454,92 @@ def download_all_images():
     
     progress_bar = st.progress(0)
     status_text = st.empty()
+    images_before = session_image_stats()
     
     for i, post in enumerate(st.session_state.posts):
         status_text.text(f"Downloading images for post {i+1}/{len(st.session_state.posts)}: {post.title[:30]}...")
+        wait_for_prefetch(post)
         post.download_images(True)
         progress_bar.progress((i + 1) / len(st.session_state.posts))
     
     status_text.text("All images downloaded!")
     st.success("All images have been downloaded!")
+    images_after = session_image_stats()
+    st.caption(f"This session's images: {images_before['encoded_bytes'] / 2**20:.1f} MB before, "
+               f"{images_after['encoded_bytes'] / 2**20:.1f} MB after")
+
+def session_image_stats():
+    """Image store stats for this session's posts only"""
+    groups = [post.downloaded_images.group for post in st.session_state.get('posts', [])
+              if hasattr(post, 'downloaded_images')]
+    return Methods.get_image_store().stats(groups)
+
+def show_memory_use():
+    """Report what this session's images hold in memory, on disk and decoded, and the server process's memory (shared by every session)"""
+    stats = session_image_stats()
+    st.caption(f"This session's images: {stats['images']} stored, {stats['encoded_bytes'] / 2**20:.1f} MB in memory, "
+               f"{stats['spilled_images']} spilled to disk, {stats['decoded_images']} decoded ({stats['decoded_bytes'] / 2**20:.1f} MB)")
 
-def generate_all_zip():
-    """Generate CSV entries for all posts, put everything into zip file."""
+    rss = Methods.current_rss_mb()
+    peak = Methods.peak_rss_mb()
+    if rss is not None and peak is not None:
+        st.caption(f"Server process, all sessions: {rss:.0f} MB now, {peak:.0f} MB peak")
+
+def generate_all_zip(posts_per_flyer=0, time_budget=0):
+    """
+    Generate CSV entries for all posts, put everything into zip file. With posts_per_flyer set, writes one CSV row per flyer.
+    If the time budget runs out, the zip is built from the images that have arrived, with placeholders for the rest.
+    """
     if 'posts' not in st.session_state:
         return
+    posts = st.session_state.posts
+    if not posts:
+        print("Error: No Posts!")
+        return
     
-    zip_buffer = Methods.ZipBuilder()
+    # Images encoded by earlier runs are reused, so re-exporting after reordering or editing text is quick
+    if 'image_cache' not in st.session_state:
+        st.session_state.image_cache = Methods.ImageCache()
     
     progress_bar = st.progress(0)
     status_text = st.empty()
-    
-    header = [ ]
-    row = [ ]
-
-    for i, post in enumerate(st.session_state.posts):
-        status_text.text(f"Generating CSV entry for post {i+1}/{len(st.session_state.posts)}: {post.title[:30]}...")
-        zip_buffer = post.zip_images(zip_buffer)
-        csv_entry = post.get_CSV_entry_zip(i)
-        # Would make more sense for each post to be its own row, with every post sharing the same headers, but ID Data Merge
-        # Only ever wants to merge one row of a CSV. There are ways around this but it's inflexible, so instead we put everything in one row
-        if csv_entry:
-            for k,j in csv_entry.items():
-                header.append(k)
-                row.append(j)
-        else:
-            print("Error: No Posts!")
-            return
+    deadline = Methods.Deadline(time_budget or None)
+    
+    def ready_posts():
+        cancelled = False
+        for i, post in enumerate(posts):
+            status_text.text(f"Generating CSV entry for post {i+1}/{len(posts)}: {post.title[:30]}...")
+            # Only blocks on posts the background prefetcher hasn't gotten to yet, and only until the budget runs out
+            if not wait_for_prefetch(post, 0 if cancelled else deadline.remaining()) and not cancelled:
+                # Out of time: stop outstanding downloads (once, not for every post still downloading) and build from what has arrived
+                st.session_state.prefetcher.cancel()
+                deadline.cancel()
+                cancelled = True
+            yield post
+            progress_bar.progress((i + 1) / len(posts))
+    
+    # ID Data Merge only ever merges one row per flyer, so by default everything goes in one row.
+    # In batch mode each row is its own flyer, and the images & QR codes are shared between them.
+    zip_buffer = build_flyer_zip(ready_posts(), Methods.ZipBuilder(st.session_state.image_cache), posts_per_flyer, deadline)
+    flyers = math.ceil(len(posts) / posts_per_flyer) if posts_per_flyer else 1
 
-        progress_bar.progress((i + 1) / len(st.session_state.posts))
+    st.success(f"ZIP file generated! ({flyers} flyer{'s' if flyers > 1 else ''})")
+    
+    # Includes background prefetching since Fetch Posts (or since the last zip)
+    prefetch_deadline = st.session_state.get('prefetch_deadline', Methods.Deadline())
+    prefetch_throttling = prefetch_deadline.throttle_stats()
+    show_throttling(deadline.throttle_stats(), prefetch_deadline.throttle_stats(since=st.session_state.get('throttling_checkpoint')))
+    st.session_state.throttling_checkpoint = prefetch_throttling
     
-    st.success("ZIP file generated!")
+    affected = [post for post in posts if post.placeholders]
+    if affected:
+        st.warning("Some images couldn't be downloaded in time, so these posts use a placeholder image:\n\n"
+                   + "\n".join(f"- {post.title}" for post in affected))
     
     st.subheader("Download here:")
     
     # Download button for ZIP
-    zip_buffer.add_csv([header,row],"flyer_autofill.csv")
+    st.session_state.image_cache.prune()
     st.download_button(
         label="Download images & CSV as ZIP",
         data=zip_buffer.getvalue(),
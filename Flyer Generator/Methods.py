@@ -1,34 +1,302 @@
-﻿import requests
-from PIL import Image
-from io import BytesIO
+﻿from io import BytesIO
 import io
 import os
-from bs4 import BeautifulSoup
 from pathlib import Path
 import zipfile
 import csv
+import hashlib
+import time
+import threading
+import tempfile
+import shutil
+import itertools
+import weakref
+import sys
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from urllib.parse import urlparse
 
-def download_image(url):
-        """Saves an image from a URL to a local file"""
+class Deadline:
+    """
+    A time budget for a job. Network calls take their timeouts from it, and skip the request
+    entirely once it has run out, so one slow host can't stall the whole job.
+    It also counts the throttling the job ran into, see throttle_report.
+    """
+
+    # Guards the counters of every Deadline, since one is shared by a job's threads
+    _lock = threading.Lock()
+
+    def __init__(self, seconds=None):
+        """Start the clock. With seconds=None there is no limit."""
+        self.end = None if seconds is None else time.monotonic() + seconds
+        self.cancelled = False
+        self.throttling = { } # host -> {'throttled': 429/503 responses, 'waited': seconds}, filled in by http_get
+
+    def remaining(self):
+        """Returns the seconds left (0 once expired or cancelled), or None if there is no limit"""
+        if self.cancelled:
+            return 0
+        if self.end is None:
+            return None
+        return max(self.end - time.monotonic(), 0)
+
+    def expired(self):
+        """True once the budget has run out or the job was cancelled"""
+        return self.remaining() == 0
+
+    def timeout(self, default):
+        """Returns a request timeout that doesn't run past the deadline (default, if there is no limit)"""
+        remaining = self.remaining()
+        return default if remaining is None else max(min(default, remaining), 0.01)
+
+    def cancel(self):
+        """Expire the deadline now, so anything still using it stops making requests"""
+        self.cancelled = True
+
+    def record_throttling(self, host, throttled=0, waited=0.0):
+        """Count 429/503 responses from host, and seconds spent waiting on its throttle, against this job"""
+        with Deadline._lock:
+            counts = self.throttling.setdefault(host, {'throttled': 0, 'waited': 0.0})
+            counts['throttled'] += throttled
+            counts['waited'] += waited
+
+    def throttle_stats(self, since=None):
+        """Returns this job's throttling counters, or only what was added after the throttle_stats() snapshot since"""
+        since = since or { }
+        with Deadline._lock:
+            return {
+                host: {key: value - since.get(host, {}).get(key, 0) for key, value in counts.items()}
+                for host, counts in self.throttling.items()
+                }
+
+### Limits for the adaptive per-host throttling in http_get
+THROTTLE_INITIAL_LIMIT = 4 # Requests in flight per host to start with
+THROTTLE_MAX_LIMIT = 16
+THROTTLE_SLOW_SECONDS = 2.0 # Responses slower than this count against the host, like errors
+THROTTLE_MAX_RETRY_AFTER = 120 # Cap on how long a Retry-After header can make us wait
+
+class ThrottledError(Exception):
+    """Raised when a host keeps answering 429/503 and we've run out of retries (or time)"""
+
+    def __init__(self, host, message):
+        super().__init__(message)
+        self.host = host
+
+class HostThrottle:
+    """
+    Adaptive concurrency limit for one host. The number of requests allowed in flight grows slowly
+    while responses are quick and successful, halves on 429/503, and shrinks on errors & slow responses.
+    A 429/503 also pauses the host for its Retry-After time.
+    """
+
+    def __init__(self, host):
+        """Initialize a throttle for host at THROTTLE_INITIAL_LIMIT."""
+        self.host = host
+        self.limit = float(THROTTLE_INITIAL_LIMIT)
+        self.in_flight = 0
+        self.blocked_until = 0
+        self.condition = threading.Condition()
+
+        # Counters across every job and session in the process, see throttle_stats
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.waited = 0.0
+
+    def acquire(self, deadline):
+        """Wait for a free request slot. Returns False if the deadline would pass first."""
+        with self.condition:
+            start = time.monotonic()
+            try:
+                while True:
+                    now = time.monotonic()
+                    if now >= self.blocked_until and self.in_flight < int(self.limit):
+                        self.in_flight += 1
+                        return True
+
+                    remaining = deadline.remaining()
+                    blocked_for = self.blocked_until - now if now < self.blocked_until else None
+                    if remaining == 0 or (remaining is not None and blocked_for is not None and blocked_for > remaining):
+                        return False
+
+                    # Wake up at least once a second, so a cancelled deadline is noticed
+                    self.condition.wait(min(t for t in (blocked_for, remaining, 1.0) if t is not None))
+            finally:
+                self.waited += time.monotonic() - start
+
+    def release(self, latency, throttled=False, failed=False, retry_after=0):
+        """Give back a request slot, and adjust the limit based on how the request went."""
+        with self.condition:
+            self.in_flight -= 1
+            self.requests += 1
+
+            if throttled:
+                self.throttled += 1
+                self.limit = max(self.limit / 2, 1)
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            elif failed or latency > THROTTLE_SLOW_SECONDS:
+                self.errors += failed
+                self.limit = max(self.limit * 0.75, 1)
+            else:
+                # Additive increase: about one more slot per round of successful requests
+                self.limit = min(self.limit + 1 / self.limit, THROTTLE_MAX_LIMIT)
+
+            self.condition.notify_all()
+
+_throttles = { }
+_throttles_lock = threading.Lock()
+
+def get_throttle(url):
+    """Returns the HostThrottle for a URL's host, shared by every request (and session) in this process"""
+    host = urlparse(url).netloc
+    with _throttles_lock:
+        if host not in _throttles:
+            _throttles[host] = HostThrottle(host)
+        return _throttles[host]
+
+def throttle_stats():
+    """
+    Returns {host: counters} for every host requested so far, across every job and session in this process.
+    For one job's share, use its Deadline.throttle_stats with throttle_report.
+    """
+    with _throttles_lock:
+        throttles = list(_throttles.values())
+
+    return {
+        throttle.host: {
+            'requests': throttle.requests,
+            'throttled': throttle.throttled,
+            'errors': throttle.errors,
+            'waited': throttle.waited,
+            'limit': int(throttle.limit)
+            }
+        for throttle in throttles
+        }
+
+def throttle_report(*job_stats):
+    """
+    Returns a list of hosts that throttled the given jobs (Deadline.throttle_stats() results, added together), with what it cost.
+    'limit' is the host's current limit, which is shared by every session.
+    """
+    totals = { }
+    for stats in job_stats:
+        for host, counts in stats.items():
+            total = totals.setdefault(host, {'throttled': 0, 'waited': 0.0})
+            total['throttled'] += counts['throttled']
+            total['waited'] += counts['waited']
+
+    limits = throttle_stats()
+    return [
+        {'host': host, 'throttled': total['throttled'], 'waited': total['waited'], 'limit': limits.get(host, {}).get('limit')}
+        for host, total in totals.items() if total['throttled']
+        ]
+
+def parse_retry_after(value):
+    """Returns the seconds a Retry-After header asks us to wait (either form), or None if it's missing or unreadable"""
+    if not value:
+        return None
 
+    try:
+        seconds = float(value)
+    except ValueError:
+        from email.utils import parsedate_to_datetime
+        from datetime import datetime, timezone
+
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+
+    return min(max(seconds, 0), THROTTLE_MAX_RETRY_AFTER)
+
+def http_get(url, deadline=None, timeout=10, max_retries=3, **kwargs):
+    """
+    requests.get through the host's HostThrottle. 429 and 503 responses are retried after their
+    Retry-After time (or an exponential backoff), up to max_retries times.
+    
+    Raises ThrottledError if the host is still throttling after that, or the deadline would pass waiting for it.
+    Other network errors are raised as usual.
+    """
+    import requests
+
+    if deadline is None:
+        deadline = Deadline()
+
+    throttle = get_throttle(url)
+    for attempt in range(max_retries + 1):
+        waiting_since = time.monotonic()
+        acquired = throttle.acquire(deadline)
+        deadline.record_throttling(throttle.host, waited=time.monotonic() - waiting_since)
+        if not acquired:
+            raise ThrottledError(throttle.host, f"{throttle.host} is throttling requests, gave up waiting before the deadline")
+
+        start = time.monotonic()
+        try:
+            response = requests.get(url, timeout=deadline.timeout(timeout), **kwargs)
+        except requests.exceptions.RequestException:
+            throttle.release(time.monotonic() - start, failed=True)
+            raise
+
+        if response.status_code not in (429, 503):
+            throttle.release(time.monotonic() - start)
+            return response
+
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        if retry_after is None:
+            retry_after = min(2 ** attempt, THROTTLE_MAX_RETRY_AFTER)
+        throttle.release(time.monotonic() - start, throttled=True, retry_after=retry_after)
+        deadline.record_throttling(throttle.host, throttled=1)
+        print(f"{throttle.host} answered {response.status_code}, retrying in {retry_after:.1f}s")
+
+    raise ThrottledError(throttle.host, f"{throttle.host} is still throttling requests (HTTP {response.status_code}) after {max_retries} retries")
+
+def download_image(url, deadline=None):
+        """Downloads an image from a URL as a PIL Image. Returns None if it can't be downloaded, or the deadline has passed."""
+        from PIL import Image
+
+        data = download_image_bytes(url, deadline)
+        if data is None:
+            return None
+        return Image.open(BytesIO(data))
+
+def download_image_bytes(url, deadline=None):
+        """
+        Downloads an image from a URL, returning its encoded bytes after checking they're a readable image.
+        Returns None if it can't be downloaded, or the deadline has passed.
+        """
+        import requests
+        from PIL import Image, UnidentifiedImageError
+
+        if deadline is None:
+            deadline = Deadline()
+
+        if deadline.expired():
+            print(f"Out of time, skipping {url}")
+            return None
+
+        data = None
         try:
             # Download the image
-            response = requests.get(url, timeout=10)
+            response = http_get(url, deadline)
             response.raise_for_status()  # Raise an HTTPError for bad responses
 
-            # Open the image
-            img = Image.open(BytesIO(response.content))
+            # Check it's an image without decoding the pixels, those are decoded when needed
+            Image.open(BytesIO(response.content)).verify()
+            data = response.content
 
         except requests.exceptions.RequestException as e:
             print(f"Network error while fetching {url}: {e}")
 
+        except ThrottledError as e:
+            print(f"Gave up on {url}: {e}")
+
         except UnidentifiedImageError:
             print(f"The content at {url} is not a valid image.")
 
-        except OSError as e:
+        except (OSError, SyntaxError) as e:
             print(f"Error saving or processing the image: {e}")
 
-        return img
+        return data
 
 
 
@@ -43,11 +311,11 @@ def save_image(img, filename):
     
     return Path(filename).resolve()
 
-def get_featured_media(post):
+def get_featured_media(post, deadline=None):
     """
     Given a WordPress post object (from the REST API),
     return the full media object for the featured image,
-    or None if not found.
+    or None if not found (or the deadline has passed before it could be looked up).
     Works for WordPress.com (no _embed) and self-hosted sites.
     """
     # Case 1: Try _embedded (self-hosted with ?_embed=1)
@@ -59,9 +327,14 @@ def get_featured_media(post):
 
     # Case 2: Use _links -> wp:featuredmedia (WordPress.com style)
     if "_links" in post and "wp:featuredmedia" in post["_links"]:
+        if deadline is None:
+            deadline = Deadline()
+        if deadline.expired():
+            return None
+
         try:
             media_url = post["_links"]["wp:featuredmedia"][0]["href"]
-            media = requests.get(media_url).json()
+            media = http_get(media_url, deadline).json()
             return media
         except Exception:
             pass
@@ -69,6 +342,7 @@ def get_featured_media(post):
 def clean_text(text):
     """Removes certain bad unicode characters and removes HTML gunk"""
     # Remove any HTML gunk
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(text, features = "html.parser")
     text = soup.get_text(separator=' ', strip=True)
 
@@ -84,17 +358,348 @@ def clean_text(text):
     print("Text cleaned.")
     return text
 
+_placeholder_image = None
+
+def placeholder_image():
+    """Returns a plain grey image, as PNG bytes, that stands in for images that couldn't be downloaded"""
+    global _placeholder_image
+
+    # Always the same bytes, so the zip only ever stores one copy of it
+    if _placeholder_image is None:
+        from PIL import Image, ImageDraw
+
+        text = "Image unavailable"
+        image = Image.new('RGB', (800, 450), (200, 200, 200))
+        draw = ImageDraw.Draw(image)
+        left, top, right, bottom = draw.textbbox((0, 0), text)
+        draw.text(((image.width - (right - left)) / 2, (image.height - (bottom - top)) / 2), text, fill=(90, 90, 90))
+
+        img_bytes = io.BytesIO()
+        image.save(img_bytes, format='PNG')
+        _placeholder_image = img_bytes.getvalue()
+
+    return _placeholder_image
+
+def image_bytes_format(data):
+    """Returns the format ('JPEG', 'PNG', ...) of encoded image bytes, read from the header only"""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        return image.format or 'PNG'
+
+def slot_suffix(index):
+    """Returns the DataMerge field suffix for a flyer slot: A-Z, then AA, AB... like spreadsheet columns"""
+    suffix = ''
+    index += 1
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        suffix = chr(remainder + 65) + suffix
+    return suffix
+
+def image_digest(image):
+    """Returns a hash of an image's pixel data, so identical images can be spotted without encoding them"""
+    digest = hashlib.sha1()
+    digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+### Memory budgets for the shared ImageStore, in bytes
+IMAGE_DECODED_BUDGET = 64 * 1024 * 1024 # Decoded pixels kept around for reuse (a 1536x864 RGB image is ~4 MB)
+IMAGE_MEMORY_BUDGET = 128 * 1024 * 1024 # Encoded image bytes kept in memory, the rest is spilled to a temp directory
+
+class ImageStore:
+    """
+    Memory-bounded store for downloaded images, shared by every post in the process.
+    
+    Images are kept as their encoded bytes (what the server sent), and only decoded when asked for.
+    Decoded images are kept in an LRU under decoded_budget bytes. Once the encoded bytes held in memory
+    go over memory_budget, the least recently used ones are written to a temp directory and read back on demand.
+    """
+    
+    def __init__(self, decoded_budget=IMAGE_DECODED_BUDGET, memory_budget=IMAGE_MEMORY_BUDGET, spill_dir=None):
+        """
+        Initialize an empty store.
+        
+        Args:
+            decoded_budget: Bytes of decoded pixels to keep cached
+            memory_budget: Bytes of encoded images to keep in memory before spilling to disk
+            spill_dir: Directory for spilled images. If None, a temp directory is made when first needed (and removed with the store)
+        """
+        self.decoded_budget = decoded_budget
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.lock = threading.RLock()
+        
+        self.encoded = OrderedDict() # key -> encoded bytes, least recently used first
+        self.spilled = { } # key -> path of the spilled bytes
+        self.encoded_size = 0
+        
+        self.decoded = OrderedDict() # key -> decoded PIL Image, least recently used first
+        self.decoded_size = 0
+    
+    def put(self, key, data):
+        """Store an image's encoded bytes under key, replacing any older image."""
+        with self.lock:
+            self.discard(key)
+            self.encoded[key] = data
+            self.encoded_size += len(data)
+            self._spill()
+    
+    def get_bytes(self, key):
+        """Returns the encoded bytes stored under key, reading them back from disk if they were spilled."""
+        with self.lock:
+            if key in self.encoded:
+                self.encoded.move_to_end(key)
+                return self.encoded[key]
+            
+            with open(self.spilled[key], 'rb') as f:
+                return f.read()
+    
+    def get(self, key):
+        """Returns the image stored under key as a PIL Image, decoding it if it isn't cached."""
+        from PIL import Image
+        
+        with self.lock:
+            if key in self.decoded:
+                self.decoded.move_to_end(key)
+                return self.decoded[key]
+            
+            image = Image.open(BytesIO(self.get_bytes(key)))
+            image.load()
+            
+            self.decoded[key] = image
+            self.decoded_size += self._decoded_size(image)
+            
+            # Evict least recently used, but always keep the image we're returning
+            while self.decoded_size > self.decoded_budget and len(self.decoded) > 1:
+                old_key, old_image = self.decoded.popitem(last=False)
+                self.decoded_size -= self._decoded_size(old_image)
+            
+            return image
+    
+    def discard(self, key):
+        """Forget the image stored under key, if any."""
+        with self.lock:
+            if key in self.encoded:
+                self.encoded_size -= len(self.encoded.pop(key))
+            
+            if key in self.spilled:
+                try:
+                    os.remove(self.spilled.pop(key))
+                except OSError:
+                    pass
+            
+            if key in self.decoded:
+                self.decoded_size -= self._decoded_size(self.decoded.pop(key))
+    
+    def discard_group(self, group):
+        """Forget every image whose key is (group, ...), see PostImages."""
+        with self.lock:
+            for key in [k for k in list(self.encoded) + list(self.spilled) if k[0] == group]:
+                self.discard(key)
+    
+    def __contains__(self, key):
+        """True if an image is stored under key."""
+        return key in self.encoded or key in self.spilled
+    
+    def stats(self, groups=None):
+        """
+        Returns counts and sizes, for reporting memory use.
+        With groups (PostImages.group numbers, e.g. one session's posts), only their images are counted.
+        """
+        with self.lock:
+            if groups is None:
+                return {
+                    'images': len(self.encoded) + len(self.spilled),
+                    'encoded_bytes': self.encoded_size,
+                    'spilled_images': len(self.spilled),
+                    'decoded_images': len(self.decoded),
+                    'decoded_bytes': self.decoded_size
+                    }
+            
+            groups = set(groups)
+            encoded = [data for key, data in self.encoded.items() if key[0] in groups]
+            decoded = [image for key, image in self.decoded.items() if key[0] in groups]
+            spilled = sum(1 for key in self.spilled if key[0] in groups)
+            return {
+                'images': len(encoded) + spilled,
+                'encoded_bytes': sum(len(data) for data in encoded),
+                'spilled_images': spilled,
+                'decoded_images': len(decoded),
+                'decoded_bytes': sum(self._decoded_size(image) for image in decoded)
+                }
+    
+    def _spill(self):
+        """Write least recently used encoded images to disk until we're back under memory_budget."""
+        while self.encoded_size > self.memory_budget and self.encoded:
+            if self.spill_dir is None:
+                self.spill_dir = tempfile.mkdtemp(prefix="flyer_images_")
+                # Ours to remove, once the store is gone or the process exits
+                weakref.finalize(self, shutil.rmtree, self.spill_dir, ignore_errors=True)
+            
+            key, data = self.encoded.popitem(last=False)
+            self.encoded_size -= len(data)
+            
+            fd, path = tempfile.mkstemp(dir=self.spill_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            self.spilled[key] = path
+    
+    def _decoded_size(self, image):
+        """Approximate bytes of pixel data held by a decoded image."""
+        return image.width * image.height * len(image.getbands())
+
+_image_store = None
+_image_store_lock = threading.Lock()
+
+def get_image_store():
+    """Returns the process-wide ImageStore, creating it with the default budgets on first use"""
+    global _image_store
+    with _image_store_lock:
+        if _image_store is None:
+            _image_store = ImageStore()
+        return _image_store
+
+def peak_rss_mb():
+    """Returns this process's peak resident memory in MB, or None where the resource module isn't available"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def current_rss_mb():
+    """Returns this process's current resident memory in MB, or None where /proc isn't available"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+class PostImages(MutableMapping):
+    """
+    A post's downloaded images, stored in the shared ImageStore rather than held as decoded images.
+    Works like a dict of key -> PIL Image (decoded on access); assign encoded bytes with put_bytes.
+    """
+    
+    _groups = itertools.count()
+    
+    def __init__(self, store=None):
+        """Initialize an empty set of images in store (the process-wide ImageStore by default)."""
+        self.store = store if store is not None else get_image_store()
+        self.group = next(PostImages._groups)
+        self.image_keys = [ ]
+        # A prefetch thread can still be adding images while the GUI thread zips them
+        self.lock = threading.Lock()
+        # Free the post's images once the post is gone
+        weakref.finalize(self, self.store.discard_group, self.group)
+    
+    def put_bytes(self, key, data):
+        """Store an image from its encoded bytes (as downloaded), without decoding it."""
+        self.store.put((self.group, key), data)
+        with self.lock:
+            if key not in self.image_keys:
+                self.image_keys.append(key)
+    
+    def get_bytes(self, key):
+        """Returns the encoded bytes of an image, e.g. for st.image, without decoding it."""
+        if key not in self.image_keys:
+            raise KeyError(key)
+        return self.store.get_bytes((self.group, key))
+    
+    def __getitem__(self, key):
+        if key not in self.image_keys:
+            raise KeyError(key)
+        return self.store.get((self.group, key))
+    
+    def __setitem__(self, key, image):
+        img_bytes = io.BytesIO()
+        image.save(img_bytes, format=getattr(image, 'format', None) or 'PNG')
+        self.put_bytes(key, img_bytes.getvalue())
+    
+    def __delitem__(self, key):
+        with self.lock:
+            self.image_keys.remove(key)
+        self.store.discard((self.group, key))
+    
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.image_keys))
+    
+    def __len__(self):
+        return len(self.image_keys)
+    
+    def __contains__(self, key):
+        return key in self.image_keys
+
+class ImageCache:
+    """
+    Remembers image hashes and encoded image bytes between ZipBuilder runs, for images that only exist
+    decoded (QR codes). Downloaded images are zipped straight from their stored bytes and don't need it.
+    
+    Keep one per session and pass it to every ZipBuilder: regenerating a zip after reordering
+    posts or editing text then only encodes images that are new since the last run. Images are
+    only weakly referenced, so the cache never keeps a decoded image alive.
+    """
+    
+    def __init__(self):
+        """Initialize an empty cache."""
+        self.digests = { } # id(image) -> (weak reference to image, digest). The reference tells a reused id apart
+        self.encoded = { } # (digest, format) -> encoded bytes
+        self.start_run()
+    
+    def start_run(self):
+        """Start tracking which entries the current ZipBuilder run uses, see prune."""
+        self.used_images = set()
+        self.used_keys = set()
+    
+    def key(self, image, image_format):
+        """Returns the (digest, format) key for an image, hashing its pixels only the first time it is seen."""
+        entry = self.digests.get(id(image))
+        if entry is None or entry[0]() is not image:
+            entry = (weakref.ref(image), image_digest(image))
+            self.digests[id(image)] = entry
+        
+        self.used_images.add(id(image))
+        return (entry[1], image_format)
+    
+    def encode(self, image, key):
+        """Returns the image encoded in key's format, encoding it only if it isn't cached yet."""
+        if key not in self.encoded:
+            img_bytes = io.BytesIO()
+            image.save(img_bytes, format=key[1])
+            self.encoded[key] = img_bytes.getvalue()
+        
+        self.used_keys.add(key)
+        return self.encoded[key]
+    
+    def prune(self):
+        """Drop everything the current run didn't use (replaced images, removed posts)."""
+        self.digests = {k: v for k, v in self.digests.items() if k in self.used_images and v[0]() is not None}
+        self.encoded = {k: v for k, v in self.encoded.items() if k in self.used_keys}
+
 class ZipBuilder:
     """
     A convenient class for building zip files in memory.
     Handles the ZipFile object lifecycle automatically.
     """
     
-    def __init__(self):
-        """Initialize a new ZipBuilder with an empty zip in memory."""
+    def __init__(self, image_cache=None):
+        """
+        Initialize a new ZipBuilder with an empty zip in memory.
+        
+        Args:
+            image_cache: Optional ImageCache shared between runs, so unchanged images are not re-encoded
+        """
         self.buffer = io.BytesIO()
         self.zipf = zipfile.ZipFile(self.buffer, 'w', zipfile.ZIP_DEFLATED)
         self.closed = False
+        self.image_paths = { } # (image digest, format) -> path of the stored copy, see add_unique_image
+        self.image_cache = image_cache if image_cache is not None else ImageCache()
+        self.image_cache.start_run()
     
     def verify_zip(self):
         """Ensure the zip file is still open for writing."""
@@ -130,10 +735,7 @@ class ZipBuilder:
         
         # Generate filename if not provided
         if filename is None:
-            extension = image_format.lower()
-            if extension == 'jpeg':
-                extension = 'jpg'
-            filename = f"image_{len(self.zipf.namelist()) + 1}.{extension}"
+            filename = self._default_image_filename(image_format)
         
         # Create full path in zip
         zip_path = self._normalize_path(location, filename)
@@ -147,6 +749,52 @@ class ZipBuilder:
         
         return self
     
+    def add_unique_image(self, image, location='', filename=None, image_format=None):
+        """
+        Add an image to the zip file, unless an identical image is already in it.
+        
+        Encoded image bytes (what ImageStore holds for downloaded images) are hashed and written as-is,
+        so they are never decoded or re-encoded. A PIL Image (a QR code) is compared by a hash of its
+        pixel data and encoded through the ImageCache. Either way a graphic shared by several posts
+        (a column header, a site logo) is only stored once, without recompression, since image
+        formats are already compressed.
+        
+        Args:
+            image: Encoded image bytes, or a PIL Image object
+            location: Directory path within zip
+            filename: Filename to use if the image is new
+            image_format: Format to encode a PIL Image in. If None, uses image's format or PNG
+        
+        Returns:
+            str: Path within the zip of the stored copy of the image
+        """
+        self.verify_zip()
+        
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            key = (hashlib.sha1(image).hexdigest(), None)
+        else:
+            if image_format is None:
+                image_format = getattr(image, 'format', None) or 'PNG'
+            key = self.image_cache.key(image, image_format)
+        
+        if key not in self.image_paths:
+            if filename is None:
+                filename = self._default_image_filename(image_format or image_bytes_format(image))
+            
+            data = image if key[1] is None else self.image_cache.encode(image, key)
+            zip_path = self._normalize_path(location, filename)
+            self.zipf.writestr(zip_path, data, compress_type=zipfile.ZIP_STORED)
+            self.image_paths[key] = zip_path
+        
+        return self.image_paths[key]
+    
+    def _default_image_filename(self, image_format):
+        """Generate a filename for an image added without one."""
+        extension = image_format.lower()
+        if extension == 'jpeg':
+            extension = 'jpg'
+        return f"image_{len(self.zipf.namelist()) + 1}.{extension}"
+    
     def add_text(self, content, filename, location='', encoding='utf-8'):
         """
         Add text content to the zip file.
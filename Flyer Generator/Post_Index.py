@@ -0,0 +1,98 @@
+import json
+import re
+import sqlite3
+import threading
+
+
+class PostIndex:
+    """
+    Local full-text index of WordPress posts, backed by an SQLite FTS5 table.
+
+    Filled by WordPressExtractor.index_posts with the cleaned title, body, author, date and link of each post,
+    plus the raw JSON, so full Post objects only need to be built for the posts that get picked.
+    """
+
+    def __init__(self, path=":memory:"):
+        """Open (or create) the index at path. The default keeps it in memory for the life of the object."""
+        # Streamlit reruns happen on different threads, so share one connection behind a lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS posts USING fts5("
+                "title, body, author, date UNINDEXED, link UNINDEXED, raw UNINDEXED, "
+                "tokenize = 'porter unicode61')"
+            )
+
+    def add(self, rows):
+        """
+        Add or replace posts in the index.
+
+        Args:
+            rows: Iterable of dicts with 'id', 'title', 'body', 'author', 'date', 'link' and 'raw' (the post's JSON)
+
+        Returns:
+            int: Number of posts written
+        """
+        values = [
+            (row['id'], row['title'], row['body'], row['author'], row['date'], row['link'], json.dumps(row['raw'], ensure_ascii=False))
+            for row in rows
+        ]
+
+        with self.lock, self.connection:
+            # The post ID is the rowid, so re-indexing a post replaces the old entry
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO posts(rowid, title, body, author, date, link, raw) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                values
+            )
+
+        return len(values)
+
+    def search(self, query, limit=50):
+        """
+        Search titles, bodies and authors. Every word in query has to match, and words match as prefixes.
+
+        Returns:
+            list: Dicts with 'id', 'title', 'author', 'date', 'link' and a highlighted 'snippet', best matches first
+        """
+        match = self._match_expression(query)
+        if not match:
+            return []
+
+        with self.lock:
+            results = self.connection.execute(
+                "SELECT rowid, title, author, date, link, snippet(posts, 1, '**', '**', '...', 16) FROM posts "
+                "WHERE posts MATCH ? ORDER BY rank LIMIT ?",
+                (match, limit)
+            ).fetchall()
+
+        return [
+            {'id': row[0], 'title': row[1], 'author': row[2], 'date': row[3], 'link': row[4], 'snippet': row[5]}
+            for row in results
+        ]
+
+    def get_raw_posts(self, post_ids):
+        """Returns the raw JSON of the given posts, in the order of post_ids. Unknown IDs are skipped."""
+        post_ids = list(post_ids)
+        if not post_ids:
+            return []
+
+        with self.lock:
+            results = self.connection.execute(
+                f"SELECT rowid, raw FROM posts WHERE rowid IN ({', '.join('?' * len(post_ids))})",
+                post_ids
+            ).fetchall()
+
+        raw_posts = {row[0]: json.loads(row[1]) for row in results}
+        return [raw_posts[post_id] for post_id in post_ids if post_id in raw_posts]
+
+    def _match_expression(self, query):
+        """Turn free text into an FTS5 query, quoting each word so punctuation can't cause syntax errors."""
+        words = re.findall(r"\w+", query)
+        return ' '.join(f'"{word}"*' for word in words)
+
+    def __len__(self):
+        """Return the number of indexed posts."""
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
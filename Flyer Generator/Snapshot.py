@@ -0,0 +1,146 @@
+"""
+Session snapshots: save a list of Posts (with their edits, chosen images and order) plus their downloaded
+images and QR codes, and load them back later without touching the network.
+
+Layout (little-endian):
+    header  - MAGIC, format version (uint16), index length (uint32)
+    index   - compact JSON: post metadata, and (offset, length) of each image blob
+    blobs   - encoded image bytes, stored back to back and uncompressed, so each image is copied out of
+              its slice as-is, with no decoding
+"""
+import io
+import json
+import struct
+
+import Methods
+from Flyer_Generator import Post
+
+MAGIC = b"FLYERSNP"
+VERSION = 1
+HEADER = struct.Struct("<8sHI")
+
+
+def dumps(posts, image_cache=None):
+    """
+    Returns a snapshot of posts as bytes.
+
+    Args:
+        posts: List of Post objects, in flyer order
+        image_cache: Optional Methods.ImageCache, so images already encoded for a zip are not encoded again
+    """
+    if image_cache is None:
+        image_cache = Methods.ImageCache()
+
+    blobs = [ ]
+    offset = 0
+
+    def add_blob_bytes(data):
+        nonlocal offset
+        blobs.append(data)
+        offset += len(data)
+        return [offset - len(data), len(data)]
+
+    def add_blob(image):
+        image_format = getattr(image, 'format', None) or 'PNG'
+        return add_blob_bytes(image_cache.encode(image, image_cache.key(image, image_format)))
+
+    entries = [ ]
+    for post in posts:
+        entry = {'state': post.get_state(), 'images': { }}
+
+        # Images are stored as the bytes they were downloaded as, no decoding or re-encoding needed
+        for key in getattr(post, 'downloaded_images', {}):
+            entry['images'][key] = add_blob_bytes(post.downloaded_images.get_bytes(key))
+
+        if getattr(post, 'qr_code', None) is not None:
+            entry['qr_code'] = add_blob(post.qr_code)
+
+        entries.append(entry)
+
+    index = json.dumps({'posts': entries}, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return b''.join([HEADER.pack(MAGIC, VERSION, len(index)), index] + blobs)
+
+
+def loads(data):
+    """
+    Returns the list of Posts stored in a snapshot. data can be bytes, or any other buffer.
+    Raises ValueError if data isn't a readable snapshot.
+    """
+    from PIL import Image, UnidentifiedImageError
+
+    # Sliced through a view, so only each image's own bytes get copied
+    with memoryview(data) as view:
+        if len(view) < HEADER.size:
+            raise ValueError("Not a flyer session snapshot.")
+
+        magic, version, index_length = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError("Not a flyer session snapshot.")
+        if version != VERSION:
+            raise ValueError(f"Unsupported snapshot version: {version}")
+
+        blobs_start = HEADER.size + index_length
+        if blobs_start > len(view):
+            raise ValueError("Snapshot is truncated.")
+        # JSON and UTF-8 errors are ValueErrors too
+        index = json.loads(bytes(view[HEADER.size:blobs_start]).decode('utf-8'))
+        check_index(index)
+
+        def blob(location):
+            start = blobs_start + location[0]
+            if start + location[1] > len(view):
+                raise ValueError("Snapshot is truncated, an image is missing.")
+            # A copy, since the image store keeps the bytes after data is gone
+            return bytes(view[start:start + location[1]])
+
+        def open_blob(location):
+            # Image.open only reads the header here, pixels are decoded when the image is first used
+            try:
+                return Image.open(io.BytesIO(blob(location)))
+            except UnidentifiedImageError:
+                raise ValueError("Snapshot contains an unreadable QR code.")
+
+        posts = [ ]
+        for entry in index['posts']:
+            post = Post.from_state(entry['state'])
+
+            # Straight into the image store as encoded bytes, decoded only when used
+            post.downloaded_images = Methods.PostImages()
+            for key, location in entry['images'].items():
+                post.downloaded_images.put_bytes(key, blob(location))
+
+            if 'qr_code' in entry:
+                post.qr_code = open_blob(entry['qr_code'])
+
+            posts.append(post)
+
+    return posts
+
+
+def check_index(index):
+    """Raise ValueError unless a snapshot index has the layout dumps writes"""
+    def is_location(value):
+        return (isinstance(value, list) and len(value) == 2
+                and all(isinstance(n, int) and not isinstance(n, bool) and n >= 0 for n in value))
+
+    if not isinstance(index, dict) or not isinstance(index.get('posts'), list):
+        raise ValueError("Snapshot index is damaged: no post list.")
+
+    for entry in index['posts']:
+        if (not isinstance(entry, dict) or not isinstance(entry.get('state'), dict)
+                or not isinstance(entry.get('images'), dict)
+                or not all(is_location(location) for location in entry['images'].values())
+                or ('qr_code' in entry and not is_location(entry['qr_code']))):
+            raise ValueError("Snapshot index is damaged: bad post entry.")
+
+
+def save(posts, path, image_cache=None):
+    """Write a snapshot of posts to a file"""
+    with open(path, 'wb') as f:
+        f.write(dumps(posts, image_cache))
+
+
+def load(path):
+    """Load the Posts from a snapshot file"""
+    with open(path, 'rb') as f:
+        return loads(f.read())
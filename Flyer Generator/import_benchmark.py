@@ -0,0 +1,113 @@
+"""
+Cold-start benchmark. Uses python -X importtime to measure how long 'import Flyer_Generator' takes
+in a fresh interpreter, and times the GUI's first render through Streamlit's AppTest.
+
+Usage:
+    python import_benchmark.py [--import-budget-ms 150] [--render-budget-ms 4000]
+
+Exits with status 1 if either measurement goes over its budget, or if a heavy dependency
+gets imported at module load again.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+### These should only be imported once their stage of the pipeline runs, never by 'import Flyer_Generator'
+LAZY_MODULES = ["requests", "bs4", "qrcode", "PIL", "pandas", "xml.etree"]
+
+DEFAULT_IMPORT_BUDGET_MS = 150
+DEFAULT_RENDER_BUDGET_MS = 4000
+
+
+def run_importtime(code):
+    """Run code in a fresh interpreter with -X importtime. Returns {module: cumulative_us} for everything it imported."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=HERE, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"'{code}' failed:\n{result.stderr}")
+
+    # Lines look like: "import time:       387 |        819 |       heapq"
+    timings = { }
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        timings[name.strip()] = int(cumulative_us)
+
+    return timings
+
+
+def measure_import(module):
+    """
+    Import module in a fresh interpreter. Returns (cumulative_us, {module: cumulative_us}) for the module
+    and the imports it pulled in, leaving out whatever the interpreter loads at startup (site, .pth files).
+    """
+    startup = run_importtime("pass")
+    timings = run_importtime(f"import {module}")
+    return timings[module], {name: us for name, us in timings.items() if name not in startup and name != module}
+
+
+def measure_first_render():
+    """Time the GUI's first AppTest run in a fresh interpreter, in milliseconds. Returns None if streamlit is not installed."""
+    script = (
+        "import time\n"
+        "start = time.perf_counter()\n"
+        "from streamlit.testing.v1 import AppTest\n"
+        "AppTest.from_file('GUI.py', default_timeout=60).run()\n"
+        "print((time.perf_counter() - start) * 1000)\n"
+    )
+    result = subprocess.run([sys.executable, "-c", script], cwd=HERE, capture_output=True, text=True)
+    if result.returncode != 0:
+        if "No module named 'streamlit'" in result.stderr:
+            return None
+        raise RuntimeError(f"GUI first render failed:\n{result.stderr}")
+
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check cold-start import time against a budget.")
+    parser.add_argument("--import-budget-ms", type=float, default=DEFAULT_IMPORT_BUDGET_MS,
+                        help="Budget for 'import Flyer_Generator' in a fresh interpreter")
+    parser.add_argument("--render-budget-ms", type=float, default=DEFAULT_RENDER_BUDGET_MS,
+                        help="Budget for the GUI's first render, including importing streamlit")
+    parser.add_argument("--top", type=int, default=10, help="How many of the slowest imports to list")
+    args = parser.parse_args()
+
+    failed = False
+
+    cumulative_us, timings = measure_import("Flyer_Generator")
+    import_ms = cumulative_us / 1000
+    print(f"import Flyer_Generator: {import_ms:.1f} ms (budget {args.import_budget_ms:.0f} ms)")
+    for name, us in sorted(timings.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"    {us / 1000:8.1f} ms  {name}")
+
+    if import_ms > args.import_budget_ms:
+        print("FAIL: import is over budget")
+        failed = True
+
+    eager = [name for name in LAZY_MODULES if name in timings]
+    if eager:
+        print(f"FAIL: imported at module load: {', '.join(eager)}")
+        failed = True
+
+    render_ms = measure_first_render()
+    if render_ms is None:
+        print("GUI first render: skipped, streamlit is not installed")
+    else:
+        print(f"GUI first render: {render_ms:.1f} ms (budget {args.render_budget_ms:.0f} ms)")
+        if render_ms > args.render_budget_ms:
+            print("FAIL: first render is over budget")
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,243 @@
+"""
+Load test for the Streamlit GUI. Starts a fake WordPress server on localhost, then drives N concurrent
+editor sessions headlessly through Streamlit's AppTest: Fetch Posts -> Fetch All Images -> Generate Zip File.
+Reports p50/p95 latency per action, plus CPU time and memory per session, for sizing hosts and catching regressions.
+
+Usage:
+    python load_test.py [--sessions 8] [--rounds 3] [--posts 10] [--images-per-post 2] [--server-latency-ms 50]
+
+Streamlit's runtime is one per process, so each session runs in its own process. CPU time and peak RSS
+are measured in each of them and summed/averaged across sessions.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import multiprocessing
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import Methods
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GUI_PATH = os.path.join(HERE, "GUI.py")
+
+ACTIONS = ["Fetch Posts", "Fetch All Images", "Generate Zip File"]
+
+
+class FakeWordPress:
+    """A WordPress REST API lookalike serving generated posts and JPEG images, on a random localhost port"""
+
+    def __init__(self, total_posts=200, images_per_post=2, image_size=(1536, 864), latency=0.0):
+        """Generate the site's content and start serving it in a background thread."""
+        from PIL import Image
+
+        self.total_posts = total_posts
+        self.images_per_post = images_per_post
+        self.latency = latency
+
+        # A handful of distinct photo-like JPEGs (smoothed noise), shared between posts like a real site's recurring graphics
+        self.images = [ ]
+        for _ in range(8):
+            small = Image.frombytes('RGB', (image_size[0] // 16, image_size[1] // 16), os.urandom(image_size[0] // 16 * (image_size[1] // 16) * 3))
+            img_bytes = io.BytesIO()
+            small.resize(image_size, Image.BILINEAR).save(img_bytes, format='JPEG', quality=85)
+            self.images.append(img_bytes.getvalue())
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def post(self, post_id):
+        """Returns the REST API JSON for one generated post"""
+        images = ''.join(
+            f'<img src="{self.url}/images/{(post_id + i) % len(self.images)}.jpg" alt="Image {i}" width="1536" height="864">'
+            for i in range(self.images_per_post)
+        )
+        return {
+            'id': post_id,
+            'date': f"2025-01-{post_id % 28 + 1:02d}T12:00:00",
+            'link': f"{self.url}/posts/{post_id}/",
+            'guid': {'rendered': f"{self.url}/?p={post_id}"},
+            'title': {'rendered': f"Load test post {post_id} &#8211; a headline"},
+            'excerpt': {'rendered': "<p>Excerpt</p>"},
+            'content': {'rendered': f"<p>{'Body text for the load test. ' * 80}</p>{images}"},
+            'author_meta': {'display_name': "Load Tester"},
+            '_embedded': {'wp:featuredmedia': [{
+                'source_url': f"{self.url}/images/{post_id % len(self.images)}.jpg",
+                'alt_text': "Featured",
+                'caption': {'rendered': ""}
+            }]}
+        }
+
+    def _handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(site.latency)
+                url = urlparse(self.path)
+
+                if url.path.startswith('/wp-json/wp/v2/posts'):
+                    query = parse_qs(url.query)
+                    per_page = int(query.get('per_page', ['10'])[0])
+                    page = int(query.get('page', ['1'])[0])
+                    ids = range((page - 1) * per_page + 1, min(page * per_page, site.total_posts) + 1)
+                    self._send(json.dumps([site.post(post_id) for post_id in ids]).encode(), 'application/json')
+                elif url.path.startswith('/images/'):
+                    index = int(url.path.rsplit('/', 1)[1].split('.')[0])
+                    self._send(site.images[index % len(site.images)], 'image/jpeg')
+                else:
+                    self.send_error(404)
+
+            def _send(self, body, content_type):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def stop(self):
+        """Stop serving."""
+        self.server.shutdown()
+
+
+def click(app, label, timeout):
+    """Click the button labelled label and rerun the app. Returns the seconds it took."""
+    button = next(b for b in app.button if b.label == label)
+    start = time.perf_counter()
+    button.click().run(timeout=timeout)
+    return time.perf_counter() - start
+
+
+def run_session(site_url, args):
+    """
+    One editor session, run in its own process (Streamlit's runtime is a per-process singleton, so AppTests
+    can't share one): load the app, then fetch, download and zip args.rounds times.
+    
+    Returns a dict of latencies per action, errors, and the process's CPU seconds and RSS (MB) for the session.
+    """
+    from streamlit.testing.v1 import AppTest
+
+    # Work in a scratch directory, so files the app writes to its working directory (posts.json) don't land in the repo
+    scratch = tempfile.TemporaryDirectory(prefix="flyer_load_test_")
+    os.chdir(scratch.name)
+
+    # Measured after imports, so only the session's own work counts
+    rss_before = Methods.peak_rss_mb()
+    cpu_before = time.process_time()
+
+    latencies = {action: [ ] for action in ACTIONS}
+    errors = [ ]
+
+    app = AppTest.from_file(GUI_PATH, default_timeout=args.timeout)
+    app.run()
+    app.sidebar.text_input[0].set_value(site_url)
+    app.sidebar.number_input[0].set_value(args.posts)
+
+    for _ in range(args.rounds):
+        for action in ACTIONS:
+            latencies[action].append(click(app, action, args.timeout))
+
+            problems = [str(e.value) for e in app.exception] + [str(e.value) for e in app.error]
+            if problems:
+                errors.append(f"{action}: {problems[0]}")
+
+    os.chdir(HERE)
+    scratch.cleanup()
+
+    return {
+        'latencies': latencies,
+        'errors': errors,
+        'cpu': time.process_time() - cpu_before,
+        'rss_before': rss_before,
+        'rss_peak': Methods.peak_rss_mb(),
+        'image_store': Methods.get_image_store().stats()
+    }
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of values"""
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent editor sessions against a fake WordPress site.")
+    parser.add_argument("--sessions", type=int, default=8, help="Concurrent editor sessions")
+    parser.add_argument("--rounds", type=int, default=3, help="Fetch/download/zip rounds per session")
+    parser.add_argument("--posts", type=int, default=10, help="Posts fetched per session (the GUI allows up to 50)")
+    parser.add_argument("--images-per-post", type=int, default=2, help="Article images in each post")
+    parser.add_argument("--server-latency-ms", type=float, default=50, help="Delay the fake server adds to every response")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds before a single action counts as hung")
+    args = parser.parse_args()
+
+    site = FakeWordPress(images_per_post=args.images_per_post, latency=args.server_latency_ms / 1000)
+
+    latencies = {action: [ ] for action in ACTIONS}
+    errors = [ ]
+    results = [ ]
+    start = time.perf_counter()
+
+    # A fresh process per session (spawned, so none inherit the server's threads)
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args.sessions, mp_context=context, max_tasks_per_child=1) as pool:
+        sessions = [pool.submit(run_session, site.url, args) for _ in range(args.sessions)]
+        for session in sessions:
+            try:
+                result = session.result()
+            except Exception as e:
+                errors.append(f"session crashed: {e!r}")
+                continue
+
+            results.append(result)
+            errors.extend(result['errors'])
+            for action in ACTIONS:
+                latencies[action].extend(result['latencies'][action])
+
+    wall = time.perf_counter() - start
+    site.stop()
+
+    print(f"{args.sessions} sessions x {args.rounds} rounds, {args.posts} posts each, in {wall:.1f}s")
+    print(f"{'action':<20}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for action in ACTIONS:
+        values = latencies[action]
+        if values:
+            print(f"{action:<20}{len(values):>7}{percentile(values, 0.5) * 1000:>10.0f}"
+                  f"{percentile(values, 0.95) * 1000:>10.0f}{max(values) * 1000:>10.0f}")
+
+    if results:
+        cpu = [result['cpu'] for result in results]
+        print(f"CPU per session: {sum(cpu) / len(cpu):.2f}s mean, {max(cpu):.2f}s max, {sum(cpu):.1f}s total")
+
+        if results[0]['rss_before'] is not None:
+            growth = [result['rss_peak'] - result['rss_before'] for result in results]
+            peaks = [result['rss_peak'] for result in results]
+            print(f"Peak RSS growth per session: {sum(growth) / len(growth):.1f} MB mean, {max(growth):.1f} MB max, "
+                  f"{sum(growth):.0f} MB total (peak RSS per session process: {sum(peaks) / len(peaks):.0f} MB mean)")
+
+        stored = [result['image_store'] for result in results]
+        print(f"Image store per session: {sum(s['images'] for s in stored) / len(stored):.0f} images, "
+              f"{sum(s['encoded_bytes'] for s in stored) / len(stored) / 2**20:.1f} MB encoded, "
+              f"{sum(s['decoded_bytes'] for s in stored) / len(stored) / 2**20:.1f} MB decoded (mean)")
+
+    if errors:
+        print(f"{len(errors)} errors, first few:")
+        for error in errors[:5]:
+            print(f"    {error}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())